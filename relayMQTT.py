@@ -2,14 +2,14 @@
 """
 MQTT Relay Controller
 
-This script listens for MQTT messages on a specified topic and uses those messages
-to control a relay connected to a Raspberry Pi via a GPIO pin. It supports robust
+This script listens for MQTT messages on a set of topics and uses those messages
+to control relays connected to a Raspberry Pi via GPIO pins. It supports robust
 MQTT connection handling with automatic reconnection attempts using exponential backoff,
 and it gracefully cleans up resources on shutdown.
 
 Features:
 - MQTT integration with automatic reconnection logic and exponential backoff
-- Relay control via Raspberry Pi GPIO
+- Control of one or more relays via Raspberry Pi GPIO over a single MQTT connection
 - Detailed logging for debugging and operational monitoring
 - Graceful shutdown via signal handling
 
@@ -17,9 +17,11 @@ Author: Seth Morrow
 Date: 2-7-2025
 """
 
-import time
+import os
 import signal
+import socket
 import sys
+import ctypes
 import logging
 import paho.mqtt.client as mqtt
 import RPi.GPIO as GPIO
@@ -29,28 +31,85 @@ from typing import Dict, Any
 # Configuration Section
 # ----------------------------
 
-# Define the GPIO pin connected to the relay
-RELAY_PIN = 17  # Use BCM numbering; update if using a different GPIO pin
+# Define the GPIO pins connected to the relays, keyed by relay name (BCM numbering).
+# Each relay is controlled through its own topic: <MQTT_TOPIC>/<relay name>.
+RELAY_PINS = {
+    "relay1": 17,  # Update or add entries to match your wiring, e.g. "relay2": 27
+}
 
 # MQTT broker configuration
 MQTT_BROKER = "192.168.1.100"  # Replace with your MQTT broker's IP address or hostname
 MQTT_PORT = 1883               # Standard MQTT port
-MQTT_TOPIC = "plc/control"     # MQTT topic to subscribe for power control commands
+MQTT_TOPIC = "plc/control"     # Base MQTT topic; commands for each relay arrive on <MQTT_TOPIC>/<relay name>
 MQTT_KEEPALIVE = 60            # Keep-alive time in seconds
+MQTT_CLIENT_ID = ""            # Optional fixed client ID; leave empty to get a unique ID from the client library/broker
+MQTT_RECONNECT_MIN_DELAY = 1   # Initial delay in seconds between reconnection attempts
+MQTT_RECONNECT_MAX_DELAY = 32  # Upper bound in seconds for the exponential reconnection backoff
+MQTT_IGNORE_RETAINED = True    # Ignore retained commands the broker replays on every (re)subscribe
+
+# Optional real-time tuning for deterministic relay latency (requires root). Leave as None/False to disable.
+RT_CPU = None          # CPU core to pin the process to, e.g. 3 (pair with the isolcpus=3 kernel boot argument)
+RT_PRIORITY = None     # SCHED_FIFO priority (1-99) for the process, e.g. 50
+RT_LOCK_MEMORY = False # Lock all current and future pages in RAM to avoid page-fault stalls
 
 # Define the messages that trigger power actions
 POWER_ON_MESSAGE = "power on"
 POWER_OFF_MESSAGE = "power off"
 
+# Bind the names used on every incoming message once, so on_message does not repeat
+# the attribute lookups on the GPIO module for each command.
+_gpio_output = GPIO.output
+_HIGH = GPIO.HIGH
+_LOW = GPIO.LOW
+
+# A single subscription covers every relay; incoming topics are mapped straight to their GPIO pin.
+MQTT_SUBSCRIPTION = f"{MQTT_TOPIC}/+"
+_PIN_BY_TOPIC: Dict[str, int] = {f"{MQTT_TOPIC}/{name}": pin for name, pin in RELAY_PINS.items()}
+
+# Encode the commands once so incoming payloads can be compared as raw bytes without decoding.
+_ON_BYTES = POWER_ON_MESSAGE.lower().encode("utf-8")
+_OFF_BYTES = POWER_OFF_MESSAGE.lower().encode("utf-8")
+
+# Payloads longer than this cannot be a command and are dropped before any other work.
+# The cap is generous so commands padded with whitespace still reach the command check.
+_MAX_PAYLOAD_LEN = 64
+
+# Flags for mlockall(2), from <sys/mman.h> on Linux
+_MCL_CURRENT = 1
+_MCL_FUTURE = 2
+
 # ----------------------------
 # Logging Setup
 # ----------------------------
 
+class StdoutHandler(logging.Handler):
+    """
+    Logging handler that writes each record directly to the standard output file descriptor.
+
+    This skips the text encoding and buffering layers of sys.stdout, so each record costs
+    a single write() system call in the common case.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.fd = sys.stdout.fileno()  # Resolved once instead of for every record.
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            data = memoryview((self.format(record) + "\n").encode("utf-8"))
+            # os.write() may write only part of a large record (e.g. a traceback sent to a pipe),
+            # so keep writing until the whole record is out.
+            while data:
+                data = data[os.write(self.fd, data):]
+        except Exception:
+            self.handleError(record)
+
 # Configure the logging system to output debug information to the console.
+# Records are stamped with their raw Unix time, which avoids a strftime() call per record.
 logging.basicConfig(
     level=logging.INFO,  # Set to DEBUG for more verbose output if needed.
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
+    format="%(created).3f [%(levelname)s] %(message)s",
+    handlers=[StdoutHandler()]
 )
 logger = logging.getLogger(__name__)
 
@@ -60,18 +119,19 @@ logger = logging.getLogger(__name__)
 
 def setup_gpio() -> None:
     """
-    Initialize the Raspberry Pi GPIO settings for the relay.
+    Initialize the Raspberry Pi GPIO settings for the relays.
 
-    This function sets the GPIO numbering mode, configures the relay pin as an output,
-    and initializes the relay to the OFF state.
+    This function sets the GPIO numbering mode, configures each relay pin as an output,
+    and initializes every relay to the OFF state.
     """
     GPIO.setmode(GPIO.BCM)              # Use Broadcom pin numbering system.
-    GPIO.setup(RELAY_PIN, GPIO.OUT)       # Configure the relay pin as an output.
-    # For an active HIGH relay:
-    # - GPIO.HIGH activates the relay (device is powered on).
-    # - GPIO.LOW deactivates the relay (device is powered off).
-    GPIO.output(RELAY_PIN, GPIO.LOW)      # Start with the device powered off.
-    logger.info("GPIO has been set up. Relay is initialized to OFF state.")
+    for pin in RELAY_PINS.values():
+        GPIO.setup(pin, GPIO.OUT)         # Configure the relay pin as an output.
+        # For an active HIGH relay:
+        # - GPIO.HIGH activates the relay (device is powered on).
+        # - GPIO.LOW deactivates the relay (device is powered off).
+        GPIO.output(pin, GPIO.LOW)        # Start with the device powered off.
+    logger.info("GPIO has been set up. %d relay(s) initialized to OFF state.", len(RELAY_PINS))
 
 def cleanup_gpio() -> None:
     """
@@ -83,6 +143,40 @@ def cleanup_gpio() -> None:
     GPIO.cleanup()
     logger.info("GPIO cleanup complete. All GPIO channels have been reset.")
 
+# ----------------------------
+# Real-Time Scheduling Setup
+# ----------------------------
+
+def setup_realtime() -> None:
+    """
+    Apply the optional real-time settings to the process.
+
+    This function pins the process to RT_CPU, switches it to the SCHED_FIFO scheduler at
+    RT_PRIORITY, and locks its memory when RT_LOCK_MEMORY is set. main() calls it before setting up
+    the GPIO and entering the MQTT loop, which runs on the same thread and handles every message.
+    Settings that cannot be applied (for example when not running as root) are logged and skipped.
+    """
+    if RT_CPU is not None:
+        try:
+            os.sched_setaffinity(0, {RT_CPU})
+            logger.info("Process pinned to CPU %d.", RT_CPU)
+        except OSError as e:
+            logger.warning("Could not pin process to CPU %d: %s", RT_CPU, e)
+
+    if RT_PRIORITY is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+            logger.info("Process scheduled with SCHED_FIFO at priority %d.", RT_PRIORITY)
+        except OSError as e:
+            logger.warning("Could not enable SCHED_FIFO at priority %d: %s", RT_PRIORITY, e)
+
+    if RT_LOCK_MEMORY:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(_MCL_CURRENT | _MCL_FUTURE) == 0:
+            logger.info("Process memory locked in RAM.")
+        else:
+            logger.warning("Could not lock process memory: %s", os.strerror(ctypes.get_errno()))
+
 # ----------------------------
 # MQTT Callback Functions
 # ----------------------------
@@ -97,14 +191,44 @@ def on_connect(client: mqtt.Client, userdata: Any, flags: Dict[str, Any], rc: in
       flags    : Response flags sent by the broker.
       rc       : The connection result (0 means success).
 
-    This function subscribes to the designated topic upon a successful connection.
+    This function subscribes to the command topics of all relays upon a successful connection.
     """
     if rc == 0:
-        logger.info("Successfully connected to MQTT broker.")
-        client.subscribe(MQTT_TOPIC)
-        logger.info(f"Subscribed to MQTT topic: {MQTT_TOPIC}")
+        # Relay commands are idempotent (repeating "power on" leaves the relay on), so QoS 0 is
+        # sufficient and avoids the acknowledgement handshakes of QoS 1 and 2.
+        client.subscribe(MQTT_SUBSCRIPTION, qos=0)
+        logger.info("Connected to MQTT broker. Subscribed to MQTT topic: %s", MQTT_SUBSCRIPTION)
     else:
-        logger.error(f"Failed to connect to MQTT broker. Return code: {rc}")
+        logger.error("Failed to connect to MQTT broker. Return code: %s", rc)
+
+def on_connect_fail(client: mqtt.Client, userdata: Any) -> None:
+    """
+    Callback function for when an attempt to connect to the MQTT broker fails.
+
+    Parameters:
+      client   : The MQTT client instance.
+      userdata : User defined data (not used here).
+
+    This function logs a one-line warning for each failed attempt; the client retries on its own.
+    """
+    logger.warning("Connection to MQTT broker at %s:%d failed. Retrying with backoff.", MQTT_BROKER, MQTT_PORT)
+
+def on_socket_open(client: mqtt.Client, userdata: Any, sock: socket.socket) -> None:
+    """
+    Callback function for when the MQTT client opens the network socket to the broker.
+
+    Parameters:
+      client   : The MQTT client instance.
+      userdata : User defined data (not used here).
+      sock     : The newly opened socket.
+
+    This function disables Nagle's algorithm so small MQTT control packets (subscriptions,
+    keep-alive pings) are sent immediately instead of being held back to be coalesced.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        logger.warning("Could not set TCP_NODELAY on the MQTT socket: %s", e)
 
 def on_disconnect(client: mqtt.Client, userdata: Any, rc: int) -> None:
     """
@@ -131,63 +255,52 @@ def on_message(client: mqtt.Client, userdata: Any, msg: mqtt.MQTTMessage) -> Non
       userdata : User defined data (not used here).
       msg      : The MQTT message instance, containing topic and payload.
 
-    This function decodes the incoming message and controls the relay based on the command received.
+    This function looks up the relay addressed by the message topic, matches the raw message payload
+    against the known commands, and controls that relay based on the command received.
     """
+    # Discard retained commands replayed by the broker on (re)subscribe; they were already acted on or are stale.
+    if MQTT_IGNORE_RETAINED and msg.retain:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Ignoring retained message on topic '%s'.", msg.topic)
+        return
+
+    # Discard payloads that are far too long to be a command without inspecting them.
+    if len(msg.payload) > _MAX_PAYLOAD_LEN:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Ignoring %d-byte payload on topic '%s'.", len(msg.payload), msg.topic)
+        return
+
     try:
-        # Decode the incoming message payload to a UTF-8 string and standardize it to lower case.
-        message = msg.payload.decode("utf-8").strip().lower()
-        logger.info(f"Received message on topic '{msg.topic}': {message}")
-
-        # Check if the message instructs to turn the device on or off.
-        if message == POWER_ON_MESSAGE:
-            logger.info("Power on command received. Activating the relay...")
-            GPIO.output(RELAY_PIN, GPIO.HIGH)  # Activate the relay (power on).
-            logger.info("Relay activated. The device is now powered on.")
-        elif message == POWER_OFF_MESSAGE:
-            logger.info("Power off command received. Deactivating the relay...")
-            GPIO.output(RELAY_PIN, GPIO.LOW)   # Deactivate the relay (power off).
-            logger.info("Relay deactivated. The device is now powered off.")
+        topic = msg.topic  # Decoded from bytes by paho on every access, so read it once.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received message on topic '%s': %r", topic, msg.payload)
+
+        pin = _PIN_BY_TOPIC.get(topic)
+        if pin is None:
+            logger.warning("Received a command for an unknown relay on topic '%s'. No action taken.", topic)
+            return
+
+        # Standardize the raw bytes (surrounding whitespace, case) and compare them against the
+        # commands. Comparing two short byte strings is cheaper than hashing the payload for a lookup.
+        # Most publishers send clean lowercase commands, so only copy the payload when it needs changing.
+        payload = msg.payload
+        if payload[:1].isspace() or payload[-1:].isspace():
+            payload = payload.strip()
+        if not payload.islower():
+            payload = payload.lower()
+        if payload == _ON_BYTES:
+            _gpio_output(pin, _HIGH)  # Activate the relay (power on).
+            logger.info("Relay on GPIO %d activated by message on topic '%s'.", pin, topic)
+        elif payload == _OFF_BYTES:
+            _gpio_output(pin, _LOW)   # Deactivate the relay (power off).
+            logger.info("Relay on GPIO %d deactivated by message on topic '%s'.", pin, topic)
         else:
-            logger.warning("Received an unrecognized command. No action taken.")
-    except UnicodeDecodeError:
-        logger.error(f"Failed to decode message payload on topic '{msg.topic}'")
+            logger.warning("Received an unrecognized command on topic '%s': %r. No action taken.",
+                           topic, payload)
     except GPIO.error as e:
-        logger.error(f"GPIO error: {e}")
+        logger.error("GPIO error: %s", e)
     except Exception as e:
-        logger.exception(f"Exception occurred while processing the message: {e}")
-
-# ----------------------------
-# MQTT Connection with Retry Logic
-# ----------------------------
-
-def connect_with_retry(client: mqtt.Client, broker: str, port: int, max_retries: int = 5) -> bool:
-    """
-    Attempt to connect to the MQTT broker with a retry mechanism using exponential backoff.
-
-    Parameters:
-      client      : The MQTT client instance.
-      broker      : The hostname or IP address of the MQTT broker.
-      port        : The port number for the MQTT broker.
-      max_retries : The maximum number of retry attempts before giving up.
-
-    Returns:
-      True if the connection was successful, False otherwise.
-    """
-    retry_interval = 1  # Start with a 1-second wait between retries.
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Attempt {attempt + 1} of {max_retries}: Connecting to MQTT broker at {broker}:{port}...")
-            client.connect(broker, port, MQTT_KEEPALIVE)
-            logger.info("Connected to MQTT broker successfully.")
-            return True  # Connection succeeded.
-        except Exception as e:
-            logger.exception(f"Connection attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_interval} seconds...")
-                time.sleep(retry_interval)
-                retry_interval *= 2  # Exponential backoff.
-    logger.error("Maximum connection attempts reached. Could not connect to the MQTT broker.")
-    return False
+        logger.exception("Exception occurred while processing the message: %s", e)
 
 # ----------------------------
 # Signal Handling for Graceful Shutdown
@@ -201,11 +314,12 @@ def signal_handler(signum: int, frame: Any) -> None:
       signum : The signal number.
       frame  : The current stack frame (not used).
 
-    This function cleans up the GPIO and exits the program.
+    This function raises SystemExit in the main thread. That interrupts whatever main() is blocked
+    in (setup, a connection attempt, the reconnection backoff or waiting for network traffic), and
+    main() then disconnects the MQTT client and cleans up the GPIO.
     """
     logger.info("Shutdown signal received. Initiating cleanup...")
-    cleanup_gpio()
-    sys.exit(0)
+    raise SystemExit(0)
 
 # ----------------------------
 # Main Program Execution
@@ -215,34 +329,50 @@ def main() -> None:
     """
     Main function that initializes the system, sets up the MQTT client and GPIO, and starts the network loop.
 
-    This function configures signal handlers for graceful shutdown, establishes the MQTT connection
-    (with retries), and enters the MQTT loop to process incoming messages continuously.
+    This function configures signal handlers for graceful shutdown and enters the MQTT loop, which
+    establishes the MQTT connection (retrying with exponential backoff) and processes incoming
+    messages continuously until a shutdown signal is received.
     """
     # Register signal handlers for SIGINT and SIGTERM to enable graceful shutdown.
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # Initialize the GPIO for controlling the relay.
-    setup_gpio()
-
     # Create an instance of the MQTT client and set up callbacks.
-    client = mqtt.Client()
+    # Use a clean session: commands missed while disconnected are stale, so the broker must not
+    # queue them for replay, and no session state is carried over between connections.
+    client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=True)
     client.on_connect = on_connect
+    client.on_connect_fail = on_connect_fail
+    client.on_socket_open = on_socket_open
     client.on_disconnect = on_disconnect
     client.on_message = on_message
 
-    # Attempt to connect to the MQTT broker with retry logic.
-    if not connect_with_retry(client, MQTT_BROKER, MQTT_PORT):
-        cleanup_gpio()
-        sys.exit(1)  # Exit if connection attempts fail.
+    # Let paho retry failed connections itself, doubling the delay after each attempt.
+    # Each attempt can block for up to MQTT_KEEPALIVE seconds while the TCP connection is opened;
+    # a shutdown signal interrupts both the attempt and the wait between attempts (see signal_handler).
+    client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY, max_delay=MQTT_RECONNECT_MAX_DELAY)
 
     try:
-        # Start the MQTT network loop which will run indefinitely and handle reconnections automatically.
-        logger.info("Entering MQTT loop to listen for messages...")
-        client.loop_forever()
+        # Apply the optional CPU pinning, scheduling and memory locking.
+        setup_realtime()
+
+        # Initialize the GPIO for controlling the relay.
+        setup_gpio()
+
+        # Queue the connection and enter the MQTT network loop, which establishes the first connection
+        # and any later reconnections, and runs until a shutdown signal raises SystemExit.
+        # Errors raised in the loop or in a callback propagate here, so they are logged and the
+        # program cleans up and exits instead of leaving the relays unattended.
+        logger.info("Connecting to MQTT broker at %s:%d...", MQTT_BROKER, MQTT_PORT)
+        client.connect_async(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
+        client.loop_forever(retry_first_connection=True)
     except Exception as e:
-        logger.exception(f"An exception occurred during the MQTT loop: {e}")
+        logger.exception("An exception occurred during the MQTT loop: %s", e)
     finally:
+        # Ignore further signals so a repeated Ctrl+C or SIGTERM cannot interrupt the cleanup.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
         # Ensure that the MQTT client disconnects and GPIO is cleaned up upon exit.
         client.disconnect()
         cleanup_gpio()